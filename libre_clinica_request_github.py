@@ -1,24 +1,252 @@
 """Uploads data to Libre Clinica from SPARQL endpoint."""
 
+import copy
 import datetime
+import dbm
+import functools
+import itertools
 import logging
 import os
+import re
+import shelve
+import sqlite3
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
-import lxml
+import lxml.etree
 import pandas as pd
 import requests
 import yaml  # type: ignore
-from bs4 import BeautifulSoup
+from lxml.builder import ElementMaker
 from pydantic import BaseModel
 from query_engine_libre_clinica_github import QueryEngine
+from requests.adapters import HTTPAdapter
 from unidecode import unidecode
 from zeep import Client
+from zeep.cache import SqliteCache
+from zeep.transports import Transport
 
 logger = logging.getLogger(__name__)
 
+# Study subject label, SS_OID and item OIDs and values, ready to be uploaded.
+PreparedSubject = Tuple[str, str, List[Tuple[str, str]]]
+
+
+class FailedUpload(NamedTuple):
+    """Study subject that failed to upload, with the error and whether retrying may help."""
+
+    subject: PreparedSubject
+    error: str
+    transient: bool
+
+
+# Number of study subjects uploaded concurrently.
+UPLOAD_WORKERS = 8
+
+# Shared HTTP session so uploads reuse keep-alive connections instead of a new TCP/TLS
+# handshake per study subject. The pool is sized to the number of upload workers.
+session = requests.Session()
+session.headers.update({"SOAPAction": '""', "Content-Type": "text/xml; charset=utf-8"})
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=UPLOAD_WORKERS))
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=UPLOAD_WORKERS))
+
+# Parser shared by all import responses. It never loads DTDs, entities or network resources and
+# recovers what it can from malformed responses.
+RESPONSE_PARSER = lxml.etree.XMLParser(
+    remove_blank_text=True, huge_tree=False, resolve_entities=False, load_dtd=False, no_network=True, recover=True
+)
+
+# Characters that XML 1.0 cannot represent, e.g. control characters such as NUL or vertical tab.
+_XML_INVALID_CHARS = re.compile("[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+
+# Gender codes of the SPARQL data and their Libre Clinica values, other values are passed as is.
+_GENDER_MAP = {1: "m", 2: "f"}
+
+# On-disk cache of the SS_OIDs found in Libre Clinica, so repeated runs skip isStudySubject for
+# known study subjects. It lives in a private per-user directory and entries expire after
+# SS_OID_CACHE_TTL seconds. shelve does not support concurrent access, hence the lock. The cache is
+# only an optimisation: if it cannot be used (dbm.error covers OSError too), LC is asked instead.
+SS_OID_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "libre_clinica_upload"
+)
+SS_OID_CACHE_PATH = os.path.join(SS_OID_CACHE_DIR, "ss_oid")
+SS_OID_CACHE_TTL = 24 * 3600
+_ss_oid_cache_lock = threading.Lock()
+
+# On-disk cache of the WSDL and XSD files of Libre Clinica, and how long (in seconds) they are kept.
+# It shares the private directory of the SS_OID cache, so other users cannot plant a WSDL in it.
+ZEEP_CACHE_PATH = os.path.join(SS_OID_CACHE_DIR, "zeep.db")
+ZEEP_CACHE_TIMEOUT = 3600
+
+SOAPENV_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+WSSE_NS = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd"
+WSU_NS = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd"
+PASSWORD_TEXT_TYPE = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-username-token-profile-1.0#PasswordText"
+DATA_NS = "http://openclinica.org/ws/data/v1"
+OPENCLINICA_NS = "http://www.openclinica.org/ns/odm_ext_v130/v3.1"
+
+# Element factories for the SOAP requests. Building the XML as a tree escapes OIDs and values.
+SOAPENV = ElementMaker(
+    namespace=SOAPENV_NS, nsmap={"soapenv": SOAPENV_NS, "v1": DATA_NS, "OpenClinica": OPENCLINICA_NS}
+)
+WSSE = ElementMaker(namespace=WSSE_NS, nsmap={"soapenv": SOAPENV_NS, "wsse": WSSE_NS, "wsu": WSU_NS})
+V1 = ElementMaker(namespace=DATA_NS)
+ODM = ElementMaker()
+
+
+def _security_element(lc_user: str, lc_password: str, password_type_attribute: str) -> lxml.etree._Element:
+    """Builds the wsse:Security element containing user and password for authentication.
+
+    Args:
+        lc_user: username for Libre Clinica
+        lc_password: password for Libre Clinica
+        password_type_attribute: name of the attribute holding the password type
+
+    Returns: the wsse:Security element
+
+    """
+    return WSSE.Security(
+        {f"{{{SOAPENV_NS}}}mustUnderstand": "1"},
+        WSSE.UsernameToken(
+            {f"{{{WSU_NS}}}Id": "UsernameToken-27777511"},
+            WSSE.Username(lc_user),
+            WSSE.Password({password_type_attribute: PASSWORD_TEXT_TYPE}, lc_password),
+        ),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def security_header(lc_user: str, lc_password: str) -> lxml.etree._Element:
+    """Builds the SOAP security header for the study subject and event services.
+
+    The header is built once per set of credentials. zeep moves header elements into the request
+    envelope, so callers should pass a copy of it to each request.
+
+    Args:
+        lc_user: username for Libre Clinica
+        lc_password: password for Libre Clinica
+
+    Returns: the wsse:Security element
+
+    """
+    return _security_element(lc_user, lc_password, "type")
+
+
+def _subject_data(config: "LCConfig", ss_oid: str, items: List[Tuple[str, str]]) -> lxml.etree._Element:
+    """Builds the SubjectData element holding the item data of a study subject.
+
+    Args:
+        config: Libre Clinica upload configuration object.
+        ss_oid: SS_OID of the study subject.
+        items: item OIDs and values to upload.
+
+    Returns: the SubjectData element
+
+    """
+    return ODM.SubjectData(
+        {"SubjectKey": ss_oid},
+        ODM.StudyEventData(
+            {"StudyEventOID": config.event_oid, "StudyEventRepeatKey": "1"},
+            ODM.FormData(
+                {"FormOID": config.form_oid, f"{{{OPENCLINICA_NS}}}Status": "initial data entry"},
+                ODM.ItemGroupData(
+                    {"ItemGroupOID": config.item_group_oid, "ItemGroupRepeatKey": "1", "TransactionType": "Insert"},
+                    *[ODM.ItemData({"ItemOID": item_oid, "Value": value}) for item_oid, value in items],
+                ),
+            ),
+        ),
+    )
+
+
+def import_request(config: "LCConfig", subjects: List[Tuple[str, List[Tuple[str, str]]]]) -> bytes:
+    """Builds the SOAP importRequest uploading the item data of study subjects.
+
+    Args:
+        config: Libre Clinica upload configuration object.
+        subjects: SS_OID and item OIDs and values of each study subject.
+
+    Returns: the serialized SOAP envelope
+
+    """
+    envelope = SOAPENV.Envelope(
+        SOAPENV.Header(_security_element(config.lc_user, config.lc_password, "Type")),
+        SOAPENV.Body(
+            V1.importRequest(
+                ODM.odm(
+                    ODM.ODM(
+                        ODM.ClinicalData(
+                            {"StudyOID": config.study_oid, "MetaDataVersionOID": "v1.0.0"},
+                            ODM.UpsertOn(
+                                {"NotStarted": "true", "DataEntryStarted": "true", "DataEntryComplete": "true"}
+                            ),
+                            *[_subject_data(config, ss_oid, items) for ss_oid, items in subjects],
+                        )
+                    )
+                )
+            )
+        ),
+    )
+    return lxml.etree.tostring(envelope)
+
+
+def _zeep_cache() -> Optional[SqliteCache]:
+    """Opens the cache of the WSDL and XSD files, or returns None if it cannot be used."""
+    try:
+        os.makedirs(SS_OID_CACHE_DIR, mode=0o700, exist_ok=True)
+        return SqliteCache(path=ZEEP_CACHE_PATH, timeout=ZEEP_CACHE_TIMEOUT)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Could not open the WSDL cache, fetching the WSDL files without it: {e}")
+        return None
+
+
+def _ss_oid_cache_key(lc_endpoint: str, study_identifier: str, ss_label: str) -> str:
+    """Returns the key of a study subject in the SS_OID cache."""
+    return f"{lc_endpoint}|{study_identifier}|{ss_label}"
+
+
+def _open_ss_oid_cache() -> shelve.Shelf:
+    """Opens the SS_OID cache, creating its private directory if needed."""
+    os.makedirs(SS_OID_CACHE_DIR, mode=0o700, exist_ok=True)
+    return shelve.open(SS_OID_CACHE_PATH)
+
+
+def _read_cached_ss_oid(cache_key: str) -> Optional[str]:
+    """Returns the cached SS_OID of a study subject, or None if it is missing or expired."""
+    try:
+        with _ss_oid_cache_lock, _open_ss_oid_cache() as ss_oid_cache:
+            entry = ss_oid_cache.get(cache_key)
+    except dbm.error as e:
+        logger.warning(f"Could not read the SS_OID cache, looking the study subject up in LC: {e}")
+        return None
+    if not isinstance(entry, tuple):
+        return None
+    oid, stored_at = entry
+    if time.time() - stored_at > SS_OID_CACHE_TTL:
+        return None
+    return oid
+
+
+def forget_ss_oid(lc_endpoint: str, study_identifier: str, ss_label: str) -> None:
+    """Removes the SS_OID of a study subject from the cache, so it is looked up in LC again.
+
+    Args:
+        lc_endpoint: endpoint URL of Libre Clinica
+        study_identifier: identifier of the study to which the study subject belongs.
+        ss_label: label of the study subject
+
+    """
+    try:
+        with _ss_oid_cache_lock, _open_ss_oid_cache() as ss_oid_cache:
+            ss_oid_cache.pop(_ss_oid_cache_key(lc_endpoint, study_identifier, ss_label), None)
+    except dbm.error as e:
+        logger.warning(f"Could not remove {ss_label} from the SS_OID cache: {e}")
+
 
 def get_lc_ss_oid(
+    client: Client,
     lc_endpoint: str,
     lc_user: str,
     lc_password: str,
@@ -34,37 +262,28 @@ def get_lc_ss_oid(
     study metadata file.
 
     Args:
+        client: SOAP client for the Libre Clinica study subject service
         lc_endpoint: endpoint URL of Libre Clinica
         lc_user: username for Libre Clinica
         lc_password: password for Libre Clinica
         study_identifier: identifier of the study to which the study subject belongs.
         ss_label: label of study subject for which we want the SS_OID
         ss_gender: gender of study subject
-        rerun: rerun if SS_OID is not found (boolean).
+        rerun: rerun if SS_OID is not found (boolean). A rerun bypasses the SS_OID cache.
 
     Returns: the Object Identifier
 
     """
     logger.info(f"Trying to get SS_OID for {ss_label}")
 
-    # Create SOAP client to interact with LC endpoint.
-    client = Client(f"{lc_endpoint}study/v1/studySubjectWsdl.wsdl")
-    # It forms the WSDL URL for the study subject service.
-
-    # Construct SOAP envelope header, containing user and password for authentication.
-    header = f"""
-    <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:v1="http://openclinica.org/ws/studySubject/v1" xmlns:bean="http://openclinica.org/ws/beans">
-        <soapenv:Header>
-            <wsse:Security soapenv:mustUnderstand="1" xmlns:wsse="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd">
-            <wsse:UsernameToken wsu:Id="UsernameToken-27777511" xmlns:wsu="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd">
-                <wsse:Username>{lc_user}</wsse:Username>
-                <wsse:Password type="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-username-token-profile-1.0#PasswordText">{lc_password}</wsse:Password>
-            </wsse:UsernameToken>
-            </wsse:Security>
-        </soapenv:Header>
-    </soapenv:Envelope>
-    """
-    header = lxml.etree.fromstring(header)[0][0]
+    cache_key = _ss_oid_cache_key(lc_endpoint, study_identifier, ss_label)
+    if not rerun:
+        oid = _read_cached_ss_oid(cache_key)
+        if oid:
+            logger.info(f"Found SS OID {oid} in cache")
+            return oid
+
+    header = copy.deepcopy(security_header(lc_user, lc_password))
 
     # Check if subject exists
     subject = {
@@ -74,47 +293,48 @@ def get_lc_ss_oid(
         "studyRef": {"identifier": study_identifier},
     }
 
-    # Check if the study subject exists in libre Clinica.
-    with client.settings(strict=False):
-        ret = client.service.isStudySubject(subject, _soapheaders=[header])
+    # Look the subject up at most twice: once more after creating it, because LC doesn't actually
+    # give us back the OID on creation.
+    for _ in range(2):
+        # Check if the study subject exists in libre Clinica.
+        with client.settings(strict=False):
+            ret = client.service.isStudySubject(subject, _soapheaders=[header])
+
+        if ret["result"] == "Success":
+            # If yes return the OID from the response:
+            oid = ret["_raw_elements"].pop().text
+            logger.info(f"Found SS OID {oid}")
+            try:
+                with _ss_oid_cache_lock, _open_ss_oid_cache() as ss_oid_cache:
+                    ss_oid_cache[cache_key] = (oid, time.time())
+            except dbm.error as e:
+                logger.warning(f"Could not store SS OID {oid} in the SS_OID cache: {e}")
+            return oid
+        elif rerun:
+            logger.info("A new Study Subject was created but its OID is still not available.")
+            return ""
 
-    if ret["result"] == "Success":
-        # If yes return the OID from the response:
-        oid = ret["_raw_elements"].pop().text
-        logger.info(f"Found SS OID {oid}")
-        return oid
-    elif not rerun:
         # Else create the Study Subject
         logger.info("Couldn't find an OID, creating a new SS")
-        subject = {
+        new_subject = {
             "label": ss_label,
             "enrollmentDate": datetime.datetime.now().strftime("%Y-%m-%d"),
-            "subject": {"gender": "m" if ss_gender == 1 else "f" if ss_gender == 2 else ss_gender},
+            "subject": {"gender": _GENDER_MAP.get(ss_gender, ss_gender)},
             "studyRef": {"identifier": study_identifier},
         }
 
         with client.settings(strict=False):
-            ret = client.service.create(subject, _soapheaders=[header])
+            ret = client.service.create(new_subject, _soapheaders=[header])
 
-        if ret["result"] == "Success":
-            # Rerun this method because LC doesn't actually give us back the OID
-            logger.info("All went well, rerunning to fetch OID")
-            return get_lc_ss_oid(
-                lc_endpoint=lc_endpoint,
-                lc_user=lc_user,
-                lc_password=lc_password,
-                study_identifier=study_identifier,
-                ss_label=ss_label,
-                ss_gender=ss_gender,
-                rerun=True,
-            )  # rerun the function recursively
-        else:
+        if ret["result"] != "Success":
             # Couldn't create user
             logger.warning(f'Could not create user: {ret["error"]}')
             return ""
-    else:
-        logger.info("A new Study Subject was created but its OID is still not available.")
-        return ""
+
+        logger.info("All went well, rerunning to fetch OID")
+        rerun = True
+
+    return ""
 
 
 class LCConfig(BaseModel):
@@ -135,6 +355,11 @@ class LCConfig(BaseModel):
     item_prefix: prefiix to add to each item name
     alternative_item_oids: dictionary for mapping column names to item OIDs.
     perform_query: to perform or not the upload configuration query in FAIR station.
+    sparql_page_size: number of rows to retrieve per SPARQL request, None to retrieve all at once.
+        Paging requires the query to have a deterministic ORDER BY clause.
+    upload_batch_size: number of study subjects to upload per import request.
+    max_retries: number of times to retry uploads that failed because of connection errors or
+        responses without a result.
 
     """
 
@@ -153,6 +378,9 @@ class LCConfig(BaseModel):
     item_prefix: str
     alternative_item_oids: None
     perform_query: bool = True
+    sparql_page_size: Optional[int] = None
+    upload_batch_size: int = 50
+    max_retries: int = 3
 
     def __init__(self, **kwargs):
         """Handle alternative item OIDs."""
@@ -161,6 +389,174 @@ class LCConfig(BaseModel):
             self.alternative_item_oids = {}
 
 
+def _prepare_subject(
+    config: LCConfig,
+    row: Tuple[Any, ...],
+    shared_clients: Dict[str, Client],
+    header: lxml.etree._Element,
+    column_indices: Dict[str, int],
+    item_oids: List[Tuple[int, str]],
+    subject_iteration: int,
+) -> PreparedSubject:
+    """Makes sure a study subject and its event exist in Libre Clinica and collects the item
+    data to upload for it.
+
+    Args:
+        config: Libre Clinica upload configuration object.
+        row: values of the SPARQL dataframe row holding the data of one study subject.
+        shared_clients: SOAP clients for the "study_subject" and "event" services.
+        header: SOAP security header used for the event service.
+        column_indices: position of the identifier and gender columns in the row.
+        item_oids: position and item OID of each data column.
+        subject_iteration: sequence number of the subject, used for logging.
+
+    Returns: the study subject label, its SS_OID and the item OIDs and values to upload.
+
+    """
+    logger.info(f"Subject iteration number: {subject_iteration}")
+    ss_label = row[column_indices["identifier"]]
+    logger.info(f"Adding subject {ss_label}")
+
+    # Get SS OID
+    ss_oid = get_lc_ss_oid(
+        client=shared_clients["study_subject"],
+        lc_endpoint=config.lc_endpoint,
+        lc_user=config.lc_user,
+        lc_password=config.lc_password,
+        study_identifier=config.study_identifier,
+        ss_label=ss_label,
+        ss_gender=row[column_indices["gender"]],
+    )
+
+    logger.info(f"Got SS_OID {ss_oid}")
+
+    event = {
+        "studySubjectRef": {"label": ss_label},
+        "studyRef": {"identifier": config.study_identifier},
+        "eventDefinitionOID": config.event_oid,
+        "startDate": "2000-01-01",
+        "location": "NL",
+    }
+
+    # Make sure the event is scheduled: for new subjects (and test), scheduling an event will
+    # not be possible
+    with shared_clients["event"].settings(strict=False):
+        ret = shared_clients["event"].service.schedule(event, _soapheaders=[copy.deepcopy(header)])
+
+    logger.info(f'Got return code {ret["result"]} for scheduling the event')
+
+    if ret["result"] == "Fail":
+        logger.warning(f'Got a non-success code back from LC: {ret["error"]}')
+
+    # Collect the items to be uploaded based on columns in df.
+    items = []
+    for index, item_oid in item_oids:
+        value = row[index]
+        if value is not None and pd.notna(value):
+            text, invalid_chars = _XML_INVALID_CHARS.subn("", str(value))
+            if invalid_chars:
+                logger.warning(f"Removed {invalid_chars} characters that XML cannot hold from {item_oid} of {ss_label}")
+            items.append((item_oid, text))
+
+    return ss_label, ss_oid, items
+
+
+def _prepare_subject_rows(
+    config: LCConfig,
+    rows: List[Tuple[Any, ...]],
+    shared_clients: Dict[str, Client],
+    header: lxml.etree._Element,
+    column_indices: Dict[str, int],
+    item_oids: List[Tuple[int, str]],
+    subject_iterations: List[int],
+) -> List[PreparedSubject]:
+    """Prepares the rows of one study subject one after another, so the subject is never created
+    concurrently.
+
+    Args:
+        config: Libre Clinica upload configuration object.
+        rows: values of the SPARQL dataframe rows holding the data of the study subject.
+        shared_clients: SOAP clients for the "study_subject" and "event" services.
+        header: SOAP security header used for the event service.
+        column_indices: position of the identifier and gender columns in the row.
+        item_oids: position and item OID of each data column.
+        subject_iterations: sequence number of each row, used for logging.
+
+    Returns: the prepared study subject of each row.
+
+    """
+    return [
+        _prepare_subject(config, row, shared_clients, header, column_indices, item_oids, subject_iteration)
+        for row, subject_iteration in zip(rows, subject_iterations)
+    ]
+
+
+def _upload_batch(
+    config: LCConfig,
+    session: requests.Session,
+    batch: List[PreparedSubject],
+) -> List[FailedUpload]:
+    """Uploads the data of a batch of study subjects to Libre Clinica in a single import request.
+
+    Args:
+        config: Libre Clinica upload configuration object.
+        session: HTTP session used to post the import request.
+        batch: study subject labels, SS_OIDs and item OIDs and values.
+
+    Returns: every subject that failed to upload, together with its error. Connection errors and
+        responses without a result are transient, rejections by LC are not.
+
+    """
+    ss_labels = [ss_label for ss_label, _, _ in batch]
+    logger.info(f"Starting upload for {ss_labels}")
+
+    # Password must be hashed to be sent to LC
+    submit_data = import_request(config, [(ss_oid, items) for _, ss_oid, items in batch])
+
+    # Send a POST request to Libre Clinica endpoint
+    try:
+        ret = session.post(f"{config.lc_endpoint}data/v1/dataWsdl.wsdl", data=submit_data, timeout=60)
+    except requests.RequestException as exc:
+        logger.warning(f"Upload request failed: {exc}")
+        return [FailedUpload(subject, str(exc), transient=True) for subject in batch]
+
+    logger.info(f"Got return code {ret.status_code} for upload")
+    response_text = ret.text
+
+    # Parse response to extract results and errors, ignoring the namespaces used by LC:
+    try:
+        response = lxml.etree.fromstring(ret.content, RESPONSE_PARSER)
+    except lxml.etree.XMLSyntaxError:
+        response = None
+    if response is not None:
+        results = [result.text or "" for result in response.iterfind(".//{*}result")]
+        errors = [error.text or "" for error in response.iterfind(".//{*}error")]
+    else:
+        results = errors = []
+
+    if not results and not errors:
+        logger.warning(f"No result or error found in response." f" Response: {response_text}")
+        return [FailedUpload(subject, "no result element", transient=True) for subject in batch]
+
+    if results and all("Success" in result for result in results):
+        logger.info(f"Succeeded in upload of {ss_labels}:")
+        logger.info(f"{results[0]}")
+        return []
+
+    # LC answers with a single result for the whole import, so a failure cannot be attributed to a
+    # subject of the batch. Upload both halves separately to find the subjects that fail.
+    if len(batch) > 1:
+        logger.info(f"Upload of {len(batch)} study subjects failed, uploading them in smaller batches")
+        middle = len(batch) // 2
+        return _upload_batch(config, session, batch[:middle]) + _upload_batch(config, session, batch[middle:])
+
+    error = errors[0] if errors else results[0]
+    logger.warning(f"Got a non-success code back from LC for {ss_labels[0]}: {error}")
+    # The SS_OID may be stale, e.g. when the subject was removed from LC, so look it up next time.
+    forget_ss_oid(config.lc_endpoint, config.study_identifier, ss_labels[0])
+    return [FailedUpload(batch[0], error, transient=False)]
+
+
 def upload_to_lc(config: LCConfig) -> None:
     """Uploads data to Libre Clinica endpoint from the SPARQL endpoint using SOAP communication.
 
@@ -178,7 +574,7 @@ def upload_to_lc(config: LCConfig) -> None:
 
     logger.info(f"Retrieving triples from {config.sparql_endpoint}")
     sparql = QueryEngine(config.sparql_endpoint)
-    df_sparql = sparql.get_sparql_dataframe(query)
+    df_sparql = sparql.get_sparql_dataframe(config.query, page_size=config.sparql_page_size)
 
     if len(df_sparql) == 0:
         logger.error(
@@ -191,142 +587,98 @@ def upload_to_lc(config: LCConfig) -> None:
     df_sparql = df_sparql.rename(columns=config.alternative_item_oids)
     logger.info(f"Have columns {df_sparql.columns}")
 
-    # Create SOAP envelope header.
-    header = f"""
-    <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:v1="http://openclinica.org/ws/event/v1" xmlns:bean="http://openclinica.org/ws/beans">
-        <soapenv:Header>
-            <wsse:Security soapenv:mustUnderstand="1" xmlns:wsse="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd">
-            <wsse:UsernameToken wsu:Id="UsernameToken-27777511" xmlns:wsu="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd">
-                <wsse:Username>{config.lc_user}</wsse:Username>
-                <wsse:Password type="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-username-token-profile-1.0#PasswordText">{config.lc_password}</wsse:Password>
-            </wsse:UsernameToken>
-            </wsse:Security>
-        </soapenv:Header>
-    </soapenv:Envelope>
-    """
-    header = lxml.etree.fromstring(header)[0][0]
-
-    failed_subjects = []
-    subject_iteration = 1
-
-    for _, row in df_sparql.iterrows():  # Iterate through subjects
-        logger.info(f"Subject iteration number: {subject_iteration}")
-        ss_label = row[identifier_colname]
-        logger.info(f"Adding subject {ss_label}")
-
-        # Get SS OID
-        ss_oid = get_lc_ss_oid(
-            lc_endpoint=config.lc_endpoint,
-            lc_user=config.lc_user,
-            lc_password=config.lc_password,
-            study_identifier=study_identifier,
-            ss_label=ss_label,
-            ss_gender=row[gender_colname],
-        )
-
-        logger.info(f"Got SS_OID {ss_oid}")
+    # Transliterate non-ASCII item data column-wise, only calling unidecode on the affected cells.
+    # The identifier is the study subject label in LC and is sent as it is. Gender is also uploaded as
+    # an item, so it is transliterated like the other item data.
+    text_columns = df_sparql.select_dtypes(include=["object", "string", "category"]).columns
+    for name in text_columns.drop(config.identifier_colname, errors="ignore"):
+        non_ascii = df_sparql[name].astype("string").str.contains(r"[^\x00-\x7f]", na=False)
+        if non_ascii.any():
+            df_sparql[name] = df_sparql[name].astype(object)
+            df_sparql.loc[non_ascii, name] = df_sparql.loc[non_ascii, name].map(unidecode)
+
+    header = security_header(config.lc_user, config.lc_password)
+    # Resolve the columns once, so rows can be read by position.
+    columns = list(df_sparql.columns)
+    column_indices = {
+        "identifier": columns.index(config.identifier_colname),
+        "gender": columns.index(config.gender_colname),
+    }
+    item_oids = [
+        (index, f"{config.item_prefix}{name}")
+        for index, name in enumerate(columns)
+        if name != config.identifier_colname
+    ]
+
+    # Create the SOAP clients once: each construction parses the WSDL. The WSDL and XSD files
+    # themselves are cached on disk, and the clients share the HTTP session of the uploads.
+    transport = Transport(cache=_zeep_cache(), session=session)
+    shared_clients = {
+        "study_subject": Client(f"{config.lc_endpoint}study/v1/studySubjectWsdl.wsdl", transport=transport),
+        "event": Client(f"{config.lc_endpoint}event/v1/eventWsdl.wsdl", transport=transport),
+    }
 
-        event = {
-            "studySubjectRef": {"label": ss_label},
-            "studyRef": {"identifier": study_identifier},
-            "eventDefinitionOID": event_oid,
-            "startDate": "2000-01-01",
-            "location": "NL",
+    failed: List[FailedUpload] = []
+    subject_iteration = itertools.count(1)
+
+    # Plain tuples are much cheaper to produce and read than the Series built by iterrows().
+    # Rows of the same study subject are grouped, so it is only looked up or created once at a time.
+    subject_rows: Dict[str, List[Tuple[Any, ...]]] = {}
+    for row in df_sparql.itertuples(index=False, name=None):
+        subject_rows.setdefault(row[column_indices["identifier"]], []).append(row)
+
+    # Preparing subjects is network bound, so subjects are processed concurrently. Their data is
+    # then uploaded in batches, to need fewer import requests.
+    batch: List[PreparedSubject] = []
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = {
+            executor.submit(
+                _prepare_subject_rows,
+                config,
+                rows,
+                shared_clients,
+                header,
+                column_indices,
+                item_oids,
+                [next(subject_iteration) for _ in rows],
+            ): (ss_label, len(rows))
+            for ss_label, rows in subject_rows.items()
         }
-
-        # Make sure the event is scheduled: for new subjects (and test), scheduling an event will
-        # not be possible
-        client = Client(f"{config.lc_endpoint}event/v1/eventWsdl.wsdl")
-        with client.settings(strict=False):
-            ret = client.service.schedule(event, _soapheaders=[header])
-
-        logger.info(f'Got return code {ret["result"]} for scheduling the event')
-
-        if ret["result"] == "Fail":
-            logger.warning(f'Got a non-success code back from LC: {ret["error"]}')
-
-        # Generate the XML for the items to be uploaded based on columns in df.
-        # Populate SOAP request with item data to facilitate upload.
-        ascii_range = 127
-        items = ""
-        for name in df_sparql.columns:
-            if name != identifier_colname:
-                if row[name] is not None and pd.notna(row[name]):
-                    if isinstance(row[name], str):
-                        if any(ord(char) > ascii_range for char in row[name]):
-                            row[name] = unidecode(row[name])
-                    items = f'{items}<ItemData ItemOID="{item_prefix}{name}" Value="{row[name]}"/>\n'
-
-        # XML for subject data
-        subject_xml = f"""
-            <SubjectData SubjectKey="{ss_oid}">
-                <StudyEventData StudyEventOID="{event_oid}" StudyEventRepeatKey="1">
-                    <FormData FormOID="{form_oid}" OpenClinica:Status="initial data entry">
-                        <ItemGroupData ItemGroupOID="{item_group_oid}" ItemGroupRepeatKey="1" TransactionType="Insert">
-                            {items}
-                        </ItemGroupData>
-                    </FormData>
-                </StudyEventData>
-            </SubjectData>
-        """
-
-        logger.info(f"Starting upload for {ss_label}")
-
-        # Password must be hashed to be sent to LC
-        submit_data = f"""
-            <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:v1="http://openclinica.org/ws/data/v1" xmlns:OpenClinica="http://www.openclinica.org/ns/odm_ext_v130/v3.1">
-                <soapenv:Header>
-                    <wsse:Security soapenv:mustUnderstand="1" xmlns:wsse="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd">
-                        <wsse:UsernameToken wsu:Id="UsernameToken-27777511" xmlns:wsu="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd">
-                            <wsse:Username>{config.lc_user}</wsse:Username>
-                            <wsse:Password Type="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-username-token-profile-1.0#PasswordText">{config.lc_password}</wsse:Password>
-                        </wsse:UsernameToken>
-                    </wsse:Security>
-                </soapenv:Header>
-                <soapenv:Body>
-                    <v1:importRequest>
-                        <odm>
-                            <ODM>
-                                <ClinicalData StudyOID="{study_oid}" MetaDataVersionOID="v1.0.0">
-                                <UpsertOn NotStarted="true" DataEntryStarted="true" DataEntryComplete="true"/>
-                                {subject_xml}
-                                </ClinicalData>
-                            </ODM>
-                        </odm>
-                    </v1:importRequest>
-                </soapenv:Body>
-            </soapenv:Envelope>
-            """
-
-        # Send a POST request to Libre Clinica endpoint
-        ret = requests.post(
-            f"{config.lc_endpoint}data/v1/dataWsdl.wsdl",
-            data=submit_data,
-            headers={"SOAPAction": '""', "Content-Type": "text/xml; charset=utf-8"},
-            timeout=60,
-        )
-
-        logger.info(f"Got return code {ret.status_code} for upload")
-        response_text = ret.text
-
-        # Parse response to extract results and errors:
-        ret = BeautifulSoup(response_text, features="lxml")
-        result = ret.find_all("result")
-
-        if len(result) > 0 and "Success" in result[0].text:
-            logger.info("Succeeded in upload:")
-            logger.info(f"{result[0].text}")
-        else:
-            error = ret.find_all("error")
-            if error:
-                logger.warning(f"Got a non-success code back from LC: {error[0].text}")
-                failed_subjects.append({"subject": ss_label, "error": error[0].text})
-                logger.info(f"Failed subject: {failed_subjects[-1]}")
-            else:
-                logger.error(f"No result or error found in response." f" Response: {response_text}\n Exiting now")
-                sys.exit(1)
-
-        subject_iteration += 1
+        for future in as_completed(futures):
+            ss_label, row_count = futures[future]
+            try:
+                prepared_subjects = future.result()
+            except Exception as exc:  # pylint: disable = W0703
+                logger.warning(f"Could not prepare subject {ss_label}: {exc}")
+                failed.extend([FailedUpload((ss_label, "", []), str(exc), transient=False)] * row_count)
+                continue
+            for prepared_subject in prepared_subjects:
+                # Subjects without an SS_OID would only make the import of their batch fail.
+                if not prepared_subject[1]:
+                    failed.append(FailedUpload(prepared_subject, "could not obtain SS_OID", transient=False))
+                    continue
+                batch.append(prepared_subject)
+                if len(batch) == config.upload_batch_size:
+                    failed.extend(_upload_batch(config, session, batch))
+                    batch = []
+    if batch:
+        failed.extend(_upload_batch(config, session, batch))
+
+    # Retry transiently failed uploads with exponential backoff. Subjects rejected by LC would fail
+    # the same way again. The prepared subjects are reused, so their SS_OIDs and events are not
+    # requested from LC again.
+    for attempt in range(config.max_retries):
+        retry_subjects = [failure.subject for failure in failed if failure.transient]
+        if not retry_subjects:
+            break
+        failed = [failure for failure in failed if not failure.transient]
+        delay = 2**attempt
+        logger.info(f"Retrying upload of {len(retry_subjects)} study subjects in {delay} seconds")
+        time.sleep(delay)
+        for start in range(0, len(retry_subjects), config.upload_batch_size):
+            failed.extend(_upload_batch(config, session, retry_subjects[start : start + config.upload_batch_size]))
+
+    failed_subjects = [{"subject": failure.subject[0], "error": failure.error} for failure in failed]
 
     if failed_subjects:
         logger.warning(f"Failed to upload these study subjects: \n" f"{failed_subjects}")
@@ -359,6 +711,9 @@ if __name__ == "__main__":
     gender_colname = upload_config["generic_list"]["gender_colname"]
     item_prefix = upload_config["generic_list"]["item_prefix"]
     query = upload_config["generic_list"]["query"]
+    sparql_page_size = upload_config["generic_list"].get("sparql_page_size")
+    upload_batch_size = upload_config["generic_list"].get("upload_batch_size", 50)
+    max_retries = upload_config["generic_list"].get("max_retries", 3)
 
     libre_clinica_config = LCConfig(
         sparql_endpoint=SPARQL_QUERY_ENDPOINT,
@@ -376,6 +731,9 @@ if __name__ == "__main__":
         item_prefix=item_prefix,
         alternative_item_oids=None,
         perform_query=True,
+        sparql_page_size=sparql_page_size,
+        upload_batch_size=upload_batch_size,
+        max_retries=max_retries,
     )
 
     upload_to_lc(libre_clinica_config)
@@ -4,17 +4,32 @@ pandas dataframe.
 
 # pylint: disable = E0401
 
+import json
 import logging
 import os
-from typing import Type
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Type
 
 import numpy as np
 import pandas as pd
 import requests
 from requests.auth import HTTPBasicAuth
 
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:  # orjson is optional, fall back to the (slower) standard library parser.
+    _json_loads = json.loads
+
 logger = logging.getLogger(__name__)
 
+# Shared stand-in for variables that are not bound in a result row.
+_UNBOUND: dict = {}
+
+_ORDER_BY = re.compile(r"\bORDER\s+BY\b", re.IGNORECASE)
+
 
 class QueryEngine:
     """This class contains functions that (1) read a SPARQL query
@@ -25,6 +40,9 @@ class QueryEngine:
     def __init__(self, service_location: str):
         """Service location is the location of the SPARQL endpoint."""
         self.__service_location = service_location
+        # Share one session, so repeated queries (e.g. result pages) reuse the connection.
+        self._session = requests.Session()
+        self._session.headers.update({"Accept": "application/sparql-results+json"})
 
     @staticmethod
     def convert(column: str, cast_to: Type):
@@ -56,9 +74,9 @@ class QueryEngine:
             query = file.read().replace("\n", " ")
         return self.get_sparql_dataframe(query)
 
-    def get_sparql_dataframe(self, query: str, auth_required: bool = True):
-        """This function executes a SPARQL query and stores its results in a
-        pandas dataframe.
+    def _post_query(self, query: str, auth_required: bool) -> dict:
+        """This function posts a SPARQL query to the endpoint and returns the decoded
+        JSON results.
         """
         query_endpoint = os.getenv("SPARQL_QUERY_ENDPOINT")  # type: ignore
 
@@ -68,48 +86,97 @@ class QueryEngine:
             password = os.getenv("USER_PWD")
 
             # Post the upload_config.yaml file query to the SPARQL endpoint.
-            result = requests.post(
+            result = self._session.post(
                 query_endpoint, auth=HTTPBasicAuth(username, password), data={"query": query}, timeout=60  # type: ignore
             )
         else:
             # Post the upload_config.yaml file query to the SPARQL endpoint.
-            result = requests.post(query_endpoint, data={"query": query}, timeout=60)  # type: ignore
+            result = self._session.post(query_endpoint, data={"query": query}, timeout=60)  # type: ignore
         logger.info(f"Received status code: {result.status_code}")
 
-        # Retrieve the relevant results from the json format.
-        processed_results = result.json()
-        columns = processed_results["head"]["vars"]
+        return _json_loads(result.content)
 
-        out = []
-        for row in processed_results["results"]["bindings"]:
-            item = []
-            for col in columns:
-                item.append(row.get(col, {}).get("value"))
-            out.append(item)  # Each row is a list of values corresponding to the columns.
+    def _query_pages(self, query: str, auth_required: bool, page_size: int) -> Iterator[dict]:
+        """This function pages through the results of a SPARQL query using LIMIT and
+        OFFSET, as the SPARQL protocol has no cursors. The next page is requested while
+        the current one is being processed.
+        """
+        offset = 0
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self._post_query, f"{query} LIMIT {page_size} OFFSET {offset}", auth_required)
+            while future is not None:
+                processed_results = future.result()
+                future = None
+                if len(processed_results["results"]["bindings"]) == page_size:
+                    offset += page_size
+                    future = executor.submit(
+                        self._post_query, f"{query} LIMIT {page_size} OFFSET {offset}", auth_required
+                    )
+                yield processed_results
+
+    def get_sparql_dataframe(self, query: str, auth_required: bool = True, page_size: Optional[int] = None):
+        """This function executes a SPARQL query and stores its results in a
+        pandas dataframe. If a page size is given, the results are retrieved in
+        pages of at most that many rows. SPARQL only guarantees the order of the
+        results with an ORDER BY clause, so paged queries need a deterministic one;
+        otherwise pages can overlap or skip rows.
+        """
+        if page_size is None:
+            pages: Iterable[dict] = [self._post_query(query, auth_required)]
+        else:
+            if page_size < 1:
+                raise ValueError(f"page_size must be at least 1, got {page_size}")
+            if not _ORDER_BY.search(query):
+                logger.warning(
+                    "Paging through a query without ORDER BY, rows may be duplicated or missed between pages"
+                )
+            pages = self._query_pages(query, auth_required, page_size)
+
+        # Retrieve the relevant results from the json format.
+        columns: List[str] = []
+        out: Dict[str, list] = {}  # Each column is a list of values of its variable.
+        first_row = None
+        for processed_results in pages:
+            if not out:
+                columns = processed_results["head"]["vars"]
+                out = {col: [] for col in columns}
+            bindings = processed_results["results"]["bindings"]
+            if first_row is None and len(bindings) > 0:
+                first_row = bindings[0]
+            for row in bindings:
+                for col in columns:
+                    out[col].append(row.get(col, _UNBOUND).get("value"))
 
         # Store relevant results in a data frame.
-        df_sparql = pd.DataFrame(out, columns=columns)
+        df_sparql = pd.DataFrame(out, columns=columns, copy=False)
 
         # Change the column types of the results dataframe.
-        if len(processed_results["results"]["bindings"]) > 0:
-            first_row = processed_results["results"]["bindings"][0]  # The first row is inspected
-            # to determine the types of the columns.
+        if first_row is not None:  # The first row is inspected to determine the types of the columns.
             literal_variable_types = {"literal", "typed-literal"}
             integer_data_types = {
                 "http://www.w3.org/2001/XMLSchema#int",
                 "http://www.w3.org/2001/XMLSchema#integer",
             }
+            category_columns = []
             for col in columns:
                 var_type = first_row.get(col, {}).get("type")
                 if var_type == "uri":
-                    df_sparql[col] = df_sparql[col].astype("category")
+                    category_columns.append(col)
                 if var_type in literal_variable_types:
                     data_type = first_row.get(col, {}).get("datatype")
+                    # Values that cannot be parsed become missing values.
                     if data_type in integer_data_types:
-                        df_sparql[col] = df_sparql[col].apply(lambda x: self.convert(x, int)).astype("Int64")
+                        # Parse to nullable types, so large integers stay exact instead of passing through float.
+                        numbers = pd.to_numeric(df_sparql[col], errors="coerce", dtype_backend="numpy_nullable")
+                        if numbers.dtype == "Float64":
+                            # Some values have a decimal point. Those with a fractional part become missing
+                            # values, integral ones such as "2.0" are kept.
+                            numbers = numbers.where(numbers % 1 == 0)
+                        df_sparql[col] = numbers.astype("Int64")
                     if data_type == "http://www.w3.org/2001/XMLSchema#double":
-                        df_sparql[col] = df_sparql[col].apply(lambda x: self.convert(x, float)).astype("Float64")
+                        df_sparql[col] = pd.to_numeric(df_sparql[col], errors="coerce").astype("Float64")
                     if data_type == "http://www.w3.org/2001/XMLSchema#string":
-                        df_sparql[col] = df_sparql[col].astype("category")
+                        category_columns.append(col)
+            df_sparql = df_sparql.astype({col: "category" for col in category_columns})
 
         return df_sparql